@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+from haversine import haversine_vector, Unit
+
+
+# Default configuration of the cleaning stage in walk(). Pass a modified copy to walk() to change it, or None to disable cleaning.
+# Note: GeoLife altitudes are given in feet, and -777 is used in the dataset when no valid altitude was recorded
+DEFAULT_CLEANING = {
+    'invalid_altitude': -777,   # Sentinel altitude that is replaced with null
+    'min_altitude': -1500,      # Altitudes outside [min_altitude, max_altitude] (feet) are replaced with null
+    'max_altitude': 45000,
+    'max_speed_kmh': 1000,      # Points that can only be reached faster than this are dropped (the dataset contains airplane trips)
+    'drop_zero_length': False,  # Drop points with the exact same position as the previous point.
+                                # Off by default since removing them creates artificial time gaps (see query 9 in Part2)
+}
+
+
+def _drop(df, remove):
+    # The previous point is already stored, so it can never be removed. Only rows of the current chunk are counted
+    remove = remove & (df['_context'] != -1).to_numpy()
+    removed = int((remove & (df['_context'] == 0).to_numpy()).sum())
+    return df[~remove], removed
+
+
+def clean_trackpoints(df, config=DEFAULT_CLEANING, previous=None, following=None):
+    """
+    Cleans the trackpoints of a single .plt file using vectorized array operations.
+    Expects a DataFrame with the columns lat, lon, altitude and date_time, sorted in file order.
+
+    When a file is cleaned in chunks, previous is the last kept point before df and following is the first raw point after it.
+    They are only used as context for the timestamp and speed checks, and are not part of the result.
+
+    Returns the cleaned DataFrame and a dict with statistics of what was removed or nulled.
+    """
+    # Mark context rows: -1 for previous, 0 for rows of df, 1 for following
+    parts = [df.assign(_context=0)]
+    if previous is not None:
+        parts.insert(0, previous.assign(_context=-1))
+    if following is not None:
+        parts.append(following.assign(_context=1))
+    df = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+
+    stats = {'raw_points': int((df['_context'] == 0).sum())}
+
+    # Reject impossible coordinates. (0, 0) is what some GPS loggers write when they have no fix
+    lat, lon = df['lat'].to_numpy(), df['lon'].to_numpy()
+    valid = (lat >= -90) & (lat <= 90) & (lon >= -180) & (lon <= 180) & ~((lat == 0) & (lon == 0))
+    df, stats['invalid_coordinates'] = _drop(df, ~valid)
+
+    # Drop duplicate and backwards timestamps, i.e. every point that is not strictly later than all points before it
+    t = df['date_time'].to_numpy().astype('int64')
+    if len(t) > 0:
+        previous_max = np.maximum.accumulate(t)
+        forward = np.concatenate(([True], t[1:] > previous_max[:-1]))
+    else:
+        forward = np.ones(0, dtype=bool)
+    df, stats['bad_timestamps'] = _drop(df, ~forward)
+
+    # Drop spikes, i.e. points that can only be reached and left again at an impossible speed.
+    # The first and last point only have one edge. They are only spikes when that edge is too fast and the other edge of their neighbour is not,
+    # since otherwise the neighbour is the spike. walk() passes the neighbouring points of a chunk as previous and following, so chunk edges are not endpoints
+    speed_outlier = np.zeros(len(df), dtype=bool)
+    if len(df) > 2:
+        coords = df[['lat', 'lon']].to_numpy()
+        dist_km = haversine_vector(coords[:-1], coords[1:], Unit.KILOMETERS)
+        hours = np.diff(df['date_time'].to_numpy().astype('int64')) / 3.6e12
+        too_fast = dist_km / hours > config['max_speed_kmh']
+        speed_outlier[1:-1] = too_fast[:-1] & too_fast[1:]
+        speed_outlier[0] = too_fast[0] and not too_fast[1]
+        speed_outlier[-1] = too_fast[-1] and not too_fast[-2]
+    df, stats['speed_outliers'] = _drop(df, speed_outlier)
+
+    # Optionally drop zero-length jumps (same position as the previous point)
+    zero_length = np.zeros(len(df), dtype=bool)
+    if config['drop_zero_length'] and len(df) > 1:
+        lat, lon = df['lat'].to_numpy(), df['lon'].to_numpy()
+        zero_length[1:] = (lat[1:] == lat[:-1]) & (lon[1:] == lon[:-1])
+    df, stats['zero_length'] = _drop(df, zero_length)
+
+    # Null out sentinel and out-of-range altitudes instead of storing them
+    df = df[df['_context'] == 0].drop('_context', axis=1).copy()
+    altitude = df['altitude'].to_numpy(dtype=float)
+    invalid_altitude = (altitude == config['invalid_altitude']) | (altitude < config['min_altitude']) | (altitude > config['max_altitude'])
+    stats['null_altitudes'] = int(invalid_altitude.sum())
+    df['altitude'] = np.where(invalid_altitude, np.nan, altitude)
+
+    stats['kept_points'] = len(df)
+    return df, stats
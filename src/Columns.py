@@ -0,0 +1,115 @@
+import struct
+
+import bson
+import numpy as np
+
+
+# Sizes of the fixed-width BSON value types the fast path can read: double, ObjectId, bool, datetime, null, int32, int64
+_FIXED_SIZES = {0x01: 8, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4, 0x12: 8}
+_NUMPY_TYPES = {0x01: '<f8', 0x08: '?', 0x09: '<i8', 0x10: '<i4', 0x12: '<i8'}
+
+
+def _layout(batch):
+    # Parses the first document of the batch. Returns its length and (name, type, value offset, value size) of every element,
+    # or None if the document holds a type that is not fixed width (other than strings)
+    length = struct.unpack_from('<i', batch)[0]
+    elements = []
+    offset = 4
+    while batch[offset] != 0:
+        element_type = batch[offset]
+        name_end = batch.index(b'\x00', offset + 1)
+        name = batch[offset + 1:name_end].decode()
+        offset = name_end + 1
+        if element_type == 0x02:
+            # String: int32 length (including the trailing null byte), then the bytes. The length is part of the layout
+            size = struct.unpack_from('<i', batch, offset)[0]
+            elements.append((name, element_type, offset + 4, size - 1))
+            offset += 4 + size
+        elif element_type in _FIXED_SIZES:
+            elements.append((name, element_type, offset, _FIXED_SIZES[element_type]))
+            offset += _FIXED_SIZES[element_type]
+        else:
+            return None
+    return length, elements
+
+
+def _fixed_layout_columns(batch, fields):
+    # Projected trackpoints usually all have the same layout: the same fields in the same order, with the same types and string lengths.
+    # Then the batch is a 2D array of documents, and every field is a column of bytes at a fixed offset that numpy can view directly.
+    # Returns None if the documents in the batch do not share a single layout
+    layout = _layout(batch)
+    if layout is None:
+        return None
+    length, elements = layout
+    if len(batch) % length != 0:
+        return None
+
+    documents = np.frombuffer(batch, dtype=np.uint8).reshape(-1, length)
+    is_value = np.zeros(length, dtype=bool)
+    for _, _, offset, size in elements:
+        is_value[offset:offset + size] = True
+
+    # Everything except the values (document length, types, field names, string lengths, terminators) must be equal in all documents.
+    # Since the length of every document is checked, the documents are also exactly the rows of the 2D array
+    structure = documents[:, ~is_value]
+    if not (structure == structure[0]).all():
+        return None
+
+    columns = {}
+    for name, element_type, offset, size in elements:
+        if name not in fields:
+            continue
+        values = documents[:, offset:offset + size]
+        if element_type == 0x02:
+            if size == 0:
+                columns[name] = np.full(len(documents), '', dtype='U1')
+            elif (values < 0x80).all():
+                columns[name] = np.ascontiguousarray(values).view(f'S{size}').ravel().astype(f'U{size}')
+            else:
+                columns[name] = np.char.decode(np.ascontiguousarray(values).view(f'S{size}').ravel(), 'utf-8')
+        elif element_type == 0x07:
+            columns[name] = np.array([bson.ObjectId(value.tobytes()) for value in values], dtype=object)
+        elif element_type == 0x0A:
+            columns[name] = None
+        elif element_type == 0x09:
+            columns[name] = np.ascontiguousarray(values).view('<i8').ravel().view('datetime64[ms]')
+        else:
+            columns[name] = np.ascontiguousarray(values).view(_NUMPY_TYPES[element_type]).ravel()
+    return columns, len(documents)
+
+
+def decode_columns(batch, fields, dtypes=None):
+    """
+    Decodes a raw BSON batch, as returned by find_raw_batches() or aggregate_raw_batches(), into one numpy array per field.
+    dtypes maps fields to numpy dtypes, e.g. {'date_time': 'datetime64[ms]'}. Missing or null values become nan/NaT for float/datetime columns.
+
+    When all documents in the batch share the same layout, the columns are read straight from the BSON bytes without creating a dict
+    (or any Python object) per document. Other batches are decoded with bson.decode_all().
+    """
+    dtypes = dtypes or {}
+    if not batch:
+        return None
+
+    fixed = _fixed_layout_columns(batch, fields)
+    if fixed is None:
+        documents = bson.decode_all(batch)
+        return {field: np.array([document.get(field) for document in documents], dtype=dtypes.get(field)) for field in fields}
+
+    columns, count = fixed
+    result = {}
+    for field in fields:
+        values = columns.get(field)
+        dtype = dtypes.get(field)
+        if values is None:
+            # Missing or null in every document
+            result[field] = np.array([None] * count, dtype=dtype)
+        elif dtype is not None:
+            result[field] = values.astype(dtype, copy=False)
+        elif values.dtype.kind == 'M':
+            # Same types as bson.decode_all() gives when no dtype is asked for
+            result[field] = values.astype(object)
+        elif values.dtype.kind == 'i':
+            result[field] = values.astype(np.int64, copy=False)
+        else:
+            result[field] = values
+    return result
@@ -1,8 +1,14 @@
-import os, re
+import os, re, time
 import pandas as pd
 from pathlib import Path
+from tabulate import tabulate
 from IPython.lib.pretty import pprint
 from DbConnector import DbConnector
+from Cleaning import DEFAULT_CLEANING, clean_trackpoints
+from Simplification import DEFAULT_SIMPLIFICATION, SimplificationReport, simplify_trackpoints
+from Sketches import GeolifeSketches
+from Tiles import TilePyramid
+from Partitions import CATALOG, TrackPointPartitions
 
 
 class Part1:
@@ -12,8 +18,8 @@ class Part1:
         self.client = self.connection.client
         self.db = self.connection.db
 
-    def create_coll(self, collection_name):
-        self.db.create_collection(collection_name)    
+    def create_coll(self, collection_name, **options):
+        self.db.create_collection(collection_name, **options)    
         print(f'Created collection: {collection_name}')
         
     def drop_coll(self, collection_name):
@@ -24,10 +30,10 @@ class Part1:
         collection = self.db[collection_name]
         collection.insert_many(data)
         
-    def fetch_documents(self, collection_name):
+    def fetch_documents(self, collection_name, limit=5):
         collection = self.db[collection_name]
-        documents = collection.find({})
-        for doc in documents[:5]: 
+        documents = collection.find({}, limit=limit, batch_size=limit)
+        for doc in documents: 
             pprint(doc, max_seq_length=8)
         
     def show_coll(self):
@@ -37,7 +43,21 @@ class Part1:
 
     
 
-def walk():
+def read_chunks(file_complete, chunk_size):
+    """
+    Reads a .plt file in chunks of at most chunk_size trackpoints, so memory use does not depend on the length of the file.
+    Yields every chunk together with the first row of the next chunk, or None for the last chunk.
+    """
+    reader = pd.read_csv(file_complete, delimiter=',', header=None, names=['lat', 'lon', 'ignore', 'altitude', 'date_days', 'date', 'time'], parse_dates={'date_time': ['date', 'time']}, skiprows=6, chunksize=chunk_size)
+    chunk = next(reader, None)
+    while chunk is not None:
+        next_chunk = next(reader, None)
+        following = None if next_chunk is None else next_chunk[['lat', 'lon', 'altitude', 'date_days', 'date_time']].iloc[:1]
+        yield chunk[['lat', 'lon', 'altitude', 'date_days', 'date_time']], following
+        chunk = next_chunk
+
+
+def walk(cleaning=DEFAULT_CLEANING, simplification=None, simplification_report=None, max_trackpoints=None, chunk_size=2500, trackpoint_sink=None, sketches=None, tiles=None):
 
     # The following relative directory structure was used. Change if yours is different
     relative_path = '../../dataset/dataset'
@@ -83,42 +103,95 @@ def walk():
 
             for file in files:
                 file_complete = root + '/' + file
-                
-                # Skip activities with more than 2500 TrackPoints
-                with open(file_complete,'r') as f:
-                    if (len(f.readlines()) > 2506):
-                        continue
 
-                # Read file to dataframe
-                df = pd.read_csv(file_complete, delimiter=',', header=None, names=['lat', 'lon', 'ignore', 'altitude', 'date_days', 'date', 'time'], parse_dates={'date_time': ['date', 'time']}, skiprows=6)
-                df = df.drop('ignore', axis=1)
-                df['activity_id'] = current_activity
-                df = df[['activity_id', 'lat', 'lon', 'altitude', 'date_days', 'date_time']]
+                # Skip activities with more TrackPoints than max_trackpoints, if set. Lines are counted without keeping the file in memory
+                if max_trackpoints is not None:
+                    with open(file_complete,'r') as f:
+                        if (sum(1 for line in f) - 6 > max_trackpoints):
+                            continue
+
+                # The activity is only created once a chunk has valid trackpoints
+                activity_dict = None
+                previous = None
+                cleaning_stats, simplification_stats = {}, {}
+                if simplification is not None and simplification_report is not None:
+                    simplification_report.start_activity()
+                if sketches is not None:
+                    sketches.start_activity(current_user)
+
+                for chunk_number, (df, following) in enumerate(read_chunks(file_complete, chunk_size)):
+
+                    # The labels in labels.txt refer to the raw start and end time of the file, so keep those for matching
+                    if chunk_number == 0:
+                        start_time_matchable = str(df['date_time'].iloc[0]).replace("-", "").replace(" ", "").replace(":", "")
+                    end_date_matchable = str(df['date_time'].iloc[-1]).replace("-", "").replace(" ", "").replace(":", "")
+
+                    # Clean data before it reaches the database. The neighbouring points of the chunk are passed as context
+                    if cleaning is not None:
+                        df, stats = clean_trackpoints(df, cleaning, previous=previous, following=following)
+                        for key, value in stats.items():
+                            cleaning_stats[key] = cleaning_stats.get(key, 0) + value
+                        if df.empty:
+                            continue
+                    previous = df.iloc[-1:]
+
+                    # Optionally only store the points needed to keep the segment within the simplification tolerance
+                    if simplification is not None:
+                        raw_df = df
+                        df, stats = simplify_trackpoints(df, simplification)
+                        simplification_stats['original_point_count'] = simplification_stats.get('original_point_count', 0) + stats['original_point_count']
+                        simplification_stats['simplification_error'] = max(simplification_stats.get('simplification_error', 0.0), stats['simplification_error'])
+                        simplification_stats['altitude_error'] = max(simplification_stats.get('altitude_error', 0.0), stats['altitude_error'])
+                        if simplification_report is not None:
+                            simplification_report.add(raw_df, df, stats)
+
+                    if activity_dict is None:
+                        activity_dict = {'_id': current_activity, 'transportation_mode': None, 'start_date_time': df['date_time'].iloc[0], 'end_date_time': None, 'trackpoint_count': 0, 'first_trackpoint': trackpoint_id, 'last_trackpoint': None}
 
-                start_date_time = df['date_time'].iloc[0]
-                end_date_time = df['date_time'].iloc[-1]
+                    # Trackpoint ids are contiguous within an activity, so the activity only references the range of its trackpoint ids.
+                    # Its size does not depend on the number of trackpoints or chunks
+                    activity_dict['last_trackpoint'] = trackpoint_id + len(df) - 1
+                    activity_dict['trackpoint_count'] += len(df)
+                    activity_dict['end_date_time'] = df['date_time'].iloc[-1]
+
+                    segment_trackpoints = []
+                    for lat, lon, altitude, date_days, date_time in df[['lat', 'lon', 'altitude', 'date_days', 'date_time']].values.tolist():
+                        altitude = None if pd.isna(altitude) else altitude  # Store missing altitudes as null
+                        tp_dict = {'_id': trackpoint_id, 'lat': lat, 'lon': lon, 'altitude': altitude, 'date_days': date_days, 'date_time': date_time, 'user_id': current_user, 'activity_id': current_activity}
+                        segment_trackpoints.append(tp_dict)
+                        trackpoint_id += 1
+
+                    if sketches is not None:
+                        sketches.add(df)
+                    if tiles is not None:
+                        tiles.add(df, current_user, current_activity)
+
+                    # Hand the trackpoints over per segment if there is a sink, so they are never all kept in memory
+                    if trackpoint_sink is not None:
+                        trackpoint_sink(segment_trackpoints)
+                    else:
+                        trackpoints.extend(segment_trackpoints)
+
+                if activity_dict is None:
+                    print(f'Skipping {file_complete}: no valid trackpoints after cleaning')
+                    continue
 
                 # Find transportation_mode by comparing start and end datetime of activity with the times in labels.txt
-                transportation_mode = None
                 if has_labels:
-                    start_time_matchable = str((start_date_time)).replace("-", "").replace(" ", "").replace(":", "")
-                    end_date_matchable = str(end_date_time).replace("-", "").replace(" ", "").replace(":", "")
-                    
                     if (start_time_matchable in start_datetimes) and (end_date_matchable in end_datetimes):
                         # Exact match found
-                        transportation_mode = modes[end_datetimes.index(end_date_matchable)]
-                
-                activity_dict = {'_id': current_activity, 'transportation_mode': transportation_mode, 'start_date_time': start_date_time, 'end_date_time': end_date_time, 'trackpoints': []}
+                        activity_dict['transportation_mode'] = modes[end_datetimes.index(end_date_matchable)]
+
+                if cleaning is not None:
+                    activity_dict['cleaning_stats'] = cleaning_stats
+                if simplification is not None:
+                    activity_dict.update(simplification_stats)
+                if sketches is not None:
+                    sketches.finish_activity(activity_dict)
                 activities.append(activity_dict)
                 user_dict['activities'].append(current_activity)
                 current_activity += 1
 
-                for activity_id, lat, lon, altitude, date_days, date_time in df.values.tolist():
-                    tp_dict = {'_id': trackpoint_id, 'lat': lat, 'lon': lon, 'altitude': altitude, 'date_days': date_days, 'date_time': date_time, 'user_id': current_user, 'activity_id': activity_id}
-                    activity_dict['trackpoints'].append(trackpoint_id)  # Add trackpoint_id to activity
-                    trackpoints.append(tp_dict)
-                    trackpoint_id += 1
-
     return users, activities, trackpoints
          
 
@@ -127,25 +200,58 @@ def main():
     program = None
     try:
         program = Part1()
+
+        # Set partition_mode to 'yearly' or 'monthly' to store trackpoints in one collection per year or month instead of TrackPoint
+        partition_mode = None
         
         # Create collections User, Activity, TrackPoint
         program.create_coll(collection_name="User")
         program.create_coll(collection_name="Activity")
-        program.create_coll(collection_name="TrackPoint")
+        # The catalog of an earlier partitioned ingest is dropped with its partitions, so Part2 never routes queries to stale partitions
+        # and the counts in the catalog are not added up twice
+        for partition in program.db[CATALOG].find({}, {'_id': 1}):
+            program.drop_coll(collection_name=partition['_id'])
+        program.drop_coll(collection_name=CATALOG)
+        if partition_mode is None:
+            program.create_coll(collection_name="TrackPoint")
+            trackpoint_sink = lambda data: program.insert_documents(collection_name="TrackPoint", data=data)
+        else:
+            trackpoint_sink = TrackPointPartitions(program.db, partition_mode).insert
+
+        start = time.time()
 
-        # Read/clean data
-        users, activities, trackpoints = walk()
+        # Read/clean data. Set simplify to True to store simplified trajectories instead of every point
+        simplify = False
+        simplification = DEFAULT_SIMPLIFICATION if simplify else None
+        simplification_report = SimplificationReport() if simplify else None
+        # Set max_trackpoints to 2500 to skip long activities like in the original assignment.
+        # TrackPoints are inserted segment by segment while reading, so long activities do not need to fit in memory
+        max_trackpoints = None
+        # Sketches for the approximate queries in Part2 are built from the stored trackpoints while reading
+        sketches = GeolifeSketches()
+        # Trackpoint density tiles for heatmaps and hotspots, merged into the TrackPointTile collection.
+        # The whole dataset is read again, so the tiles are rebuilt like the sketches. Merging into the stored tiles would count every trackpoint twice
+        program.drop_coll(collection_name="TrackPointTile")
+        tiles = TilePyramid(program.db)
+        users, activities, _ = walk(simplification=simplification, simplification_report=simplification_report, max_trackpoints=max_trackpoints,
+                                    trackpoint_sink=trackpoint_sink, sketches=sketches, tiles=tiles)
+        tiles.flush()
+        if simplification_report is not None:
+            rows, headers = simplification_report.rows()
+            print(tabulate(rows, headers))
 
         # Insert data
         program.insert_documents(collection_name="User", data=users)
         program.insert_documents(collection_name="Activity", data=activities)
-        program.insert_documents(collection_name="TrackPoint", data=trackpoints)
+        sketches.save(program.db)
+        print(f'Ingested dataset in {time.time() - start:.1f} s')  # Compare with the restore time of Snapshot.py
 
         # Fetch data
         program.show_coll()
         program.fetch_documents(collection_name="User")
         program.fetch_documents(collection_name="Activity")
-        program.fetch_documents(collection_name="TrackPoint")
+        if partition_mode is None:
+            program.fetch_documents(collection_name="TrackPoint")
         
     except Exception as e:
         print("ERROR: Failed to use database:", e)
@@ -1,10 +1,18 @@
 import datetime
+import math
+import time
 
+import numpy as np
+import pandas as pd
 import pymongo
 from DbConnector import DbConnector
 from tabulate import tabulate
 from haversine import haversine, Unit
 from pymongo import GEOSPHERE
+from Sketches import CountMinSketch, HyperLogLog
+from Tiles import tile_bounds, tile_index
+from Partitions import trackpoint_collections
+from Columns import decode_columns
 
 
 class GeolifeQueries:
@@ -15,11 +23,50 @@ class GeolifeQueries:
         self.db = self.connection.db
         
 
+    # Routing layer for trackpoints. Returns the collections that can hold trackpoints recorded from start (inclusive) to end (exclusive),
+    # in chronological order. This is only the TrackPoint collection, unless trackpoints were stored in time partitions (see Partitions.py).
+    # Raises a RuntimeError if archived partitions overlap the time range, so queries never silently give partial answers
+    def trackpoint_collections(self, start=None, end=None, include_archived=True):
+        return trackpoint_collections(self.db, start, end, include_archived)
+
+
+    # Trackpoint ids are contiguous within an activity, so all its trackpoints are found with a single range on _id
+    def activity_trackpoint_filter(self, activity):
+        return {'_id': {'$gte': activity['first_trackpoint'], '$lte': activity['last_trackpoint']}}
+
+
+    # Scans a collection and yields the projected fields as chunks of typed numpy columns, e.g. {'altitude': array([...]), ...},
+    # instead of one Python dict per document. Documents are fetched as raw BSON batches of batch_size documents,
+    # and the columns are read straight from the BSON bytes of every batch (see Columns.py).
+    # Either filter/sort (find) or pipeline (aggregate) can be given. limit is applied on the server, 0 means no limit.
+    # dtypes maps fields to numpy dtypes, e.g. {'date_time': 'datetime64[ms]'}. Missing or null values become nan/NaT for float/datetime columns
+    def scan(self, collection_name, fields, filter=None, sort=None, pipeline=None, batch_size=50000, limit=0, dtypes=None):
+        collection = self.db[collection_name]
+
+        # Only the asked fields are returned, so all documents have the same layout as often as possible
+        projection = {field: 1 for field in fields}
+        if '_id' not in fields:
+            projection['_id'] = 0
+
+        if pipeline is not None:
+            pipeline = pipeline + [{'$project': projection}]
+            if limit:
+                pipeline.append({'$limit': limit})
+            batches = collection.aggregate_raw_batches(pipeline, batchSize=batch_size, allowDiskUse=True)
+        else:
+            batches = collection.find_raw_batches(filter or {}, projection, sort=sort, batch_size=batch_size, limit=limit)
+
+        for batch in batches:
+            columns = decode_columns(batch, fields, dtypes)
+            if columns is not None:
+                yield columns
+
+
     # 1: How many users, activities and trackpoints are there in the dataset (after it is inserted into the database).
     def AllTableCounts(self):
         user_count = self.db['User'].count_documents({})
         activity_count = self.db['Activity'].count_documents({})
-        tp_count = self.db['TrackPoint'].count_documents({})
+        tp_count = sum(self.db[collection_name].count_documents({}) for collection_name in self.trackpoint_collections())
         return [('User', user_count), ('Activity', activity_count), ('TrackPoint', tp_count)], ("collection", "count")
 
 
@@ -193,38 +240,41 @@ class GeolifeQueries:
         # From these ids, get activity documents with 'walk' as transportation_mode
         walking_activities = self.db['Activity'].find({'_id': {'$in': activity_ids}, 'transportation_mode': 'walk'})
 
+        start_2008, end_2008 = datetime.datetime(2008, 1, 1), datetime.datetime(2009, 1, 1)
+
         total_dist = 0
         for a in walking_activities:
-            # Get trackpoints from this activity. Ensure they are sorted chronologically
-            trackpoints = self.db['TrackPoint'].find({'_id': {'$in': a['trackpoints']}}).sort('date_time', 1)
-            trackpoints = list(trackpoints)
-
-            # Calculate total distance
-            for i in range(len(trackpoints)-1):
-
-                # Skip if trackpoints not recorded in 2008
-                if trackpoints[i]['date_time'].year != 2008 or trackpoints[i+1]['date_time'].year != 2008:
-                    continue
-                
-                lat1, lon1 = trackpoints[i]['lat'], trackpoints[i]['lon']
-                lat2, lon2 = trackpoints[i+1]['lat'], trackpoints[i+1]['lon']
-                dist = haversine((lat1, lon1), (lat2, lon2), unit=Unit.KILOMETERS)
-                total_dist += dist
+            # Only count pairs of trackpoints that were both recorded in 2008, so only read the trackpoints of the activity from 2008
+            trackpoint_filter = self.activity_trackpoint_filter(a)
+            trackpoint_filter['date_time'] = {'$gte': start_2008, '$lt': end_2008}
+
+            # Calculate total distance. The partitions overlapping both the activity and 2008 are read in chronological order,
+            # and each cursor is consumed one pair of trackpoints at a time, so long activities are never loaded at once.
+            # Trackpoint ids are chronological within an activity, so sorting on _id walks the index of the range filter instead of sorting in memory
+            previous = None
+            for collection_name in self.trackpoint_collections(max(a['start_date_time'], start_2008), min(a['end_date_time'] + datetime.timedelta(seconds=1), end_2008)):
+                for tp in self.db[collection_name].find(trackpoint_filter, sort=[('_id', 1)]):
+                    if previous is not None:
+                        lat1, lon1 = previous['lat'], previous['lon']
+                        lat2, lon2 = tp['lat'], tp['lon']
+                        dist = haversine((lat1, lon1), (lat2, lon2), unit=Unit.KILOMETERS)
+                        total_dist += dist
+                    previous = tp
 
         return [(total_dist,)], ("DistanceWalkedByUser112In2008",)
     
 
     # 8: Find the top 20 users who have gained the most altitude meters.
+    # Note: altitude only counts as gained when it rises above the highest altitude seen so far in the activity,
+    # so the gain of an activity is its highest altitude minus its first altitude
     def Top20AltitudeGainers(self):
 
-        result = []
-
         pipeline = [
             {
-                # Filter away trackpoints with invalid altitudes
+                # Filter away trackpoints with invalid altitudes (nulled out during ingestion, see Cleaning.py)
                 '$match':
                 {
-                    'altitude': {'$ne': -777}
+                    'altitude': {'$ne': None}
                 }
             },
             {
@@ -235,112 +285,61 @@ class GeolifeQueries:
                     'activity_id': 1,
                     'date_time': 1
                 }  
-            },
-            {
-                # Include only the following relevant fields
-                '$project': {'user_id': 1, 'activity_id': 1, 'altitude': 1}
             }
         ]
 
-        trackpoints = self.db['TrackPoint'].aggregate(pipeline)
-        trackpoints = list(trackpoints)
-
-        current_user = None
-        current_activity = None
-        last_altitude = None
-        cumulative_altitude_gain = 0
-        for tp in trackpoints:
+        # First and highest altitude of every activity, computed per chunk of trackpoints.
+        # An activity can be split over two chunks or time partitions, so the chunk results are combined once more afterwards
+        per_chunk = []
+        for collection_name in self.trackpoint_collections():
+            for chunk in self.scan(collection_name, ['user_id', 'activity_id', 'altitude'], pipeline=pipeline, dtypes={'activity_id': 'int64', 'altitude': 'float64'}):
+                trackpoints = pd.DataFrame(chunk)
+                per_chunk.append(trackpoints.groupby('activity_id', sort=False).agg(user_id=('user_id', 'first'), first=('altitude', 'first'), highest=('altitude', 'max')))
 
-            # If next trackpoint is from new user
-            if tp['user_id'] != current_user:
-                # Save result for user
-                result.append((current_user, cumulative_altitude_gain))
+        if not per_chunk:
+            return [], ("id", "total_meters_gained")
 
-                # Reset cumulative altitude gain for next user
-                cumulative_altitude_gain = 0
+        activities = pd.concat(per_chunk).groupby(level=0, sort=False).agg(user_id=('user_id', 'first'), first=('first', 'first'), highest=('highest', 'max'))
+        gain = (activities['highest'] - activities['first']) / 3.281
 
-                # Set current_user and current_activity and skip to next iteration
-                current_user = tp['user_id']
-                current_activity = tp['activity_id']
-                last_altitude = tp['altitude']
-                continue
-
-            # If next trackpoint is from new activity of the same user
-            if tp['activity_id'] != current_activity:
-                # Set current_user and current_activity and skip to next iteration
-                current_activity = tp['activity_id']
-                last_altitude = tp['altitude']
-                continue
-                
-            if tp['altitude'] > last_altitude:
-                cumulative_altitude_gain += (tp['altitude'] - last_altitude) / 3.281
-                last_altitude = tp['altitude']
-        
-        # Sort result by altitude gain descending
-        result = sorted(result, key=lambda tup: tup[1], reverse=True)
+        # Sum per user and sort by altitude gain descending
+        result = gain.groupby(activities['user_id']).sum().sort_values(ascending=False)
 
-        return result[:20], ("id", "total_meters_gained")
+        return [(user_id, float(meters)) for user_id, meters in result.head(20).items()], ("id", "total_meters_gained")
 
     # 9: Find all users who have invalid activities, and the number of invalid activities per user
+    # Note: an activity is invalid if two consecutive trackpoints deviate by 5 minutes or more.
+    # The original loop only updated the previous date_time at the start of every activity, so it compared every trackpoint with the first one,
+    # and flagged every activity longer than 5 minutes. Trackpoints are now compared with the one before them, which gives fewer invalid activities
     def UsersWithInvalidActivities(self):
 
-        trackpoints = self.db["TrackPoint"].find({},{"user_id":1, "activity_id": 1, "date_time" : 1 })
-
-
-        current_user = None
-        current_activity = None
-        last_date_time = None
-        invalidated = False
-        
-        result= {}
-        added = False
-
-        for object in trackpoints: 
-            vals = list(object.values())
-            *_, date_time, user_id, activity_id = vals
-            
-         
-            if user_id != current_user:
-                # New user reached, also new activity
-                print("now checking user ", user_id)
-                result[user_id] = 0
-                current_user = user_id
-                current_activity = None
-                invalidated = False
-                added = False
-
-            if activity_id == current_activity and invalidated:
-                if not added:
-                    result[user_id] += 1
-                    
-                    added = True
-                continue
-
-            if activity_id != current_activity:
-                # new activity reached, this needs to be treated as the previous datetime in the next iteration
-                # if activity is already invalidated, skip until we reach the next activity or user
-                current_activity = activity_id
-                last_date_time = date_time
-                invalidated = False
-                added = False
-                continue
-            
-            if date_time:
-                date_time = datetime.datetime.strptime(str(date_time),"%Y-%m-%d %H:%M:%S" )
-                last_date_time= datetime.datetime.strptime(str(last_date_time),"%Y-%m-%d %H:%M:%S")
-                time_diff = date_time - last_date_time
-                minutes_diff = minutes_diff = divmod(time_diff.total_seconds(), 60)[0]
-            
-            
-                if minutes_diff >= 5.0:
-                    invalidated = True
-        
-          
-        not_in = [x for x,y in result.items() if y == 0]
-        result = {x:y for x, y in result.items() if y != 0} # remove users with 0 invalid activities
-       
-        print(not_in)
-        return list(result.items()), ('user_id', '# of invalid activities')
+        # Trackpoints are inserted per activity in chronological order, so sorting on _id keeps consecutive trackpoints next to each other.
+        # last_date_time holds the last trackpoint of every activity seen so far, since an activity can continue in the next chunk or time partition
+        invalid_activities = {}
+        last_date_time = {}
+        for collection_name in self.trackpoint_collections():
+            for chunk in self.scan(collection_name, ['user_id', 'activity_id', 'date_time'], sort=[('_id', 1)], dtypes={'activity_id': 'int64', 'date_time': 'datetime64[ms]'}):
+                user_ids, activity_ids, date_times = chunk['user_id'], chunk['activity_id'], chunk['date_time']
+
+                same_activity = activity_ids[1:] == activity_ids[:-1]
+                long_gap = (date_times[1:] - date_times[:-1]) >= np.timedelta64(5, 'm')
+                invalid = np.concatenate(([False], same_activity & long_gap))
+
+                # Compare the first trackpoint of every run of the same activity with the last trackpoint of that activity before the run
+                run_starts = np.flatnonzero(np.concatenate(([True], ~same_activity)))
+                run_ends = np.concatenate((run_starts[1:], [len(activity_ids)])) - 1
+                for run_start, run_end in zip(run_starts, run_ends):
+                    activity_id = activity_ids[run_start]
+                    if activity_id in last_date_time and date_times[run_start] - last_date_time[activity_id] >= np.timedelta64(5, 'm'):
+                        invalid[run_start] = True
+                    last_date_time[activity_id] = date_times[run_end]
+
+                for user_id, activity_id in zip(user_ids[invalid], activity_ids[invalid]):
+                    invalid_activities.setdefault(user_id, set()).add(activity_id)
+
+        # Only users with at least one invalid activity are included
+        result = [(user_id, len(activity_ids)) for user_id, activity_ids in sorted(invalid_activities.items())]
+        return result, ('user_id', '# of invalid activities')
     
 
     # 10: Find the users who have tracked an activity in the Forbidden City of Beijing.
@@ -371,10 +370,11 @@ class GeolifeQueries:
         ]
 
         user_set = set()
-        for doc in self.db["TrackPoint"].aggregate(pipeline):
-            vals = list(doc.values())
-            *_, lat, lon, user_id = vals
-            user_set.add(user_id)
+        for collection_name in self.trackpoint_collections():
+            for doc in self.db[collection_name].aggregate(pipeline):
+                vals = list(doc.values())
+                *_, lat, lon, user_id = vals
+                user_set.add(user_id)
 
         return [(user, ) for user in user_set], ("User that visited Forbidden City of Bejing",)
     
@@ -488,6 +488,136 @@ class GeolifeQueries:
         return result, ("user_id", "most_used_transportation_mode")
 
 
+    # Approximate queries. These are answered from the sketches built during ingestion (see Sketches.py) instead of scanning TrackPoint,
+    # and every answer comes with an error estimate. ApproximationReport compares them with exact answers.
+
+    # Range of sketch grid cells that overlap the square with half side radius_km around (lat, lon).
+    # "Near" is defined as inside these cells, for both the approximate and the exact queries
+    def sketch_cells(self, lat, lon, radius_km):
+        config = self.db['Sketch'].find_one({'_id': 'config'})
+        cell_size = config['cell_size']
+        delta_lat = radius_km / 111.32
+        delta_lon = radius_km / (111.32 * math.cos(math.radians(lat)))
+        lat_range = (math.floor((lat - delta_lat) / cell_size), math.floor((lat + delta_lat) / cell_size))
+        lon_range = (math.floor((lon - delta_lon) / cell_size), math.floor((lon + delta_lon) / cell_size))
+        box = (lat_range[0] * cell_size, lon_range[0] * cell_size, (lat_range[1] + 1) * cell_size, (lon_range[1] + 1) * cell_size)
+        return config, lat_range, lon_range, box
+
+    # Approximate number of distinct users near (lat, lon), by merging the HyperLogLogs of the grid cells
+    def ApproxUsersNear(self, lat, lon, radius_km=1.0):
+        config, lat_range, lon_range, _ = self.sketch_cells(lat, lon, radius_km)
+        cells = self.db['SketchCell'].find({'lat_index': {'$gte': lat_range[0], '$lte': lat_range[1]}, 'lon_index': {'$gte': lon_range[0], '$lte': lon_range[1]}}, {'users': 1})
+
+        users = HyperLogLog(config['p'])
+        for cell in cells:
+            users.merge(HyperLogLog.from_binary(cell['users'], config['p']))
+
+        estimate = users.estimate()
+        return [(estimate, estimate * users.relative_error())], ("approx_distinct_users", "standard_error")
+
+    def UsersNear(self, lat, lon, radius_km=1.0):
+        _, _, _, (min_lat, min_lon, max_lat, max_lon) = self.sketch_cells(lat, lon, radius_km)
+        users = set()
+        for collection_name in self.trackpoint_collections():
+            users.update(self.db[collection_name].distinct('user_id', {'lat': {'$gte': min_lat, '$lt': max_lat}, 'lon': {'$gte': min_lon, '$lt': max_lon}}))
+        return [(len(users),)], ("distinct_users",)
+
+    # Approximate number of trackpoints near (lat, lon), scaled up from the reservoir sample of every activity that overlaps the area
+    def ApproxTrackPointsNear(self, lat, lon, radius_km=1.0):
+        _, _, _, (min_lat, min_lon, max_lat, max_lon) = self.sketch_cells(lat, lon, radius_km)
+        samples = self.db['ActivitySample'].find(
+            {'min_lat': {'$lt': max_lat}, 'max_lat': {'$gte': min_lat}, 'min_lon': {'$lt': max_lon}, 'max_lon': {'$gte': min_lon}},
+            {'point_count': 1, 'lat': 1, 'lon': 1}
+        )
+
+        estimate, variance = 0.0, 0.0
+        for sample in samples:
+            sample_lat, sample_lon = np.array(sample['lat']), np.array(sample['lon'])
+            k, n = len(sample_lat), sample['point_count']
+            share = np.count_nonzero((sample_lat >= min_lat) & (sample_lat < max_lat) & (sample_lon >= min_lon) & (sample_lon < max_lon)) / k
+            estimate += n * share
+
+            # Variance of the estimated count when sampling k of n points without replacement
+            if n > 1:
+                variance += n * n * share * (1 - share) / k * (n - k) / (n - 1)
+
+        return [(estimate, math.sqrt(variance))], ("approx_trackpoints", "standard_error")
+
+    def TrackPointsNear(self, lat, lon, radius_km=1.0):
+        _, _, _, (min_lat, min_lon, max_lat, max_lon) = self.sketch_cells(lat, lon, radius_km)
+        count = sum(self.db[collection_name].count_documents({'lat': {'$gte': min_lat, '$lt': max_lat}, 'lon': {'$gte': min_lon, '$lt': max_lon}})
+                    for collection_name in self.trackpoint_collections())
+        return [(count,)], ("trackpoints",)
+
+    # Approximate version of query 8. Gains are never underestimated, and overestimated by at most max_overestimate with high probability
+    def ApproxTop20AltitudeGainers(self):
+        document = self.db['Sketch'].find_one({'_id': 'altitude_gain'})
+        error = CountMinSketch.from_document(document).error()
+        return [(f'{user_id:03d}', gain, error) for user_id, gain in document['top'][:20]], ("id", "approx_total_meters_gained", "max_overestimate")
+
+    # Approximate version of query 6b
+    def ApproxYearWithMostRecordedHours(self):
+        document = self.db['Sketch'].find_one({'_id': 'year_seconds'})
+        error = CountMinSketch.from_document(document).error()
+        year, seconds = document['top'][0]
+        return [(year, seconds / 3600, error / 3600)], ("Year", "Approx number of hours recorded", "max_overestimate")
+
+    # Compares the approximate queries with their exact counterparts, including the time each of them took
+    def ApproximationReport(self, lat=39.916, lon=116.397, radius_km=1.0):
+
+        def timed(query, *args):
+            start = time.time()
+            rows, _ = query(*args)
+            return rows, time.time() - start
+
+        result = []
+
+        exact, exact_time = timed(self.UsersNear, lat, lon, radius_km)
+        approx, approx_time = timed(self.ApproxUsersNear, lat, lon, radius_km)
+        result.append(('distinct users near (lat, lon)', exact[0][0], approx[0][0], approx[0][1], exact_time, approx_time))
+
+        exact, exact_time = timed(self.TrackPointsNear, lat, lon, radius_km)
+        approx, approx_time = timed(self.ApproxTrackPointsNear, lat, lon, radius_km)
+        result.append(('trackpoints near (lat, lon)', exact[0][0], approx[0][0], approx[0][1], exact_time, approx_time))
+
+        # Compare the set of top 20 users, and the altitude gain of the top user
+        exact, exact_time = timed(self.Top20AltitudeGainers)
+        approx, approx_time = timed(self.ApproxTop20AltitudeGainers)
+        overlap = len({row[0] for row in exact} & {row[0] for row in approx})
+        result.append(('top 20 altitude gainers found', len(exact), overlap, None, exact_time, approx_time))
+        result.append(('altitude gain of top user (m)', exact[0][1] if exact else None, approx[0][1] if approx else None, approx[0][2] if approx else None, exact_time, approx_time))
+
+        exact, exact_time = timed(self.yearWithMostRecordedHours)
+        approx, approx_time = timed(self.ApproxYearWithMostRecordedHours)
+        result.append(('year with most recorded hours', exact[0][0], approx[0][0], None, exact_time, approx_time))
+        result.append(('hours recorded that year', exact[0][1], approx[0][1], approx[0][2], exact_time, approx_time))
+
+        return result, ("question", "exact", "approximate", "error estimate", "exact seconds", "approximate seconds")
+
+
+    # Trackpoint density per tile at the given zoom level, for every tile that overlaps the bounding box.
+    # Read from the tile pyramid built during ingestion (see Tiles.py), so only the tiles in the box are touched
+    def TileDensity(self, min_lat, min_lon, max_lat, max_lon, zoom):
+        # Tile y grows towards the south, so the northern edge gives the smallest y
+        min_x, min_y = tile_index(max_lat, min_lon, zoom)
+        max_x, max_y = tile_index(min_lat, max_lon, zoom)
+
+        tiles = self.db['TrackPointTile'].find({'z': zoom, 'x': {'$gte': int(min_x), '$lte': int(max_x)}, 'y': {'$gte': int(min_y), '$lte': int(max_y)}})
+
+        result = [(tile['z'], tile['x'], tile['y'], tile['count'], len(tile['users']), HyperLogLog.from_binary(tile['activities']).estimate()) for tile in tiles]
+        return result, ("zoom", "x", "y", "trackpoints", "distinct_users", "approx_distinct_activities")
+
+    # The n tiles with the most trackpoints at the given zoom level, with the coordinates of their center
+    def Hotspots(self, zoom, n=20):
+        tiles = self.db['TrackPointTile'].find({'z': zoom}, {'z': 1, 'x': 1, 'y': 1, 'count': 1, 'users': 1}, sort=[('count', -1)], limit=n)
+
+        result = []
+        for tile in tiles:
+            min_lat, min_lon, max_lat, max_lon = tile_bounds(tile['z'], tile['x'], tile['y'])
+            result.append(((min_lat + max_lat) / 2, (min_lon + max_lon) / 2, tile['count'], len(tile['users'])))
+        return result, ("lat", "lon", "trackpoints", "distinct_users")
+
+
 def main():
     program = None
     try:
@@ -556,6 +686,16 @@ def main():
         rows, headers = program.UsersWithTransportationModes()
         print(tabulate(rows, headers))
 
+        # Where do users go: the 20 densest tiles of about 470 x 470 meters at the latitude of Beijing
+        if 'TrackPointTile' in program.db.list_collection_names():
+            rows, headers = program.Hotspots(zoom=16)
+            print(tabulate(rows, headers))
+
+        # Approximate answers from the sketches built during ingestion, compared with the exact queries
+        if 'Sketch' in program.db.list_collection_names():
+            rows, headers = program.ApproximationReport()
+            print(tabulate(rows, headers))
+
     except Exception as e:
         print("ERROR: Failed to use database:", e)
     finally:
@@ -0,0 +1,75 @@
+from pymongo import UpdateOne
+
+
+# Catalog of the time partitions, with the time range and number of trackpoints of each partition
+CATALOG = 'TrackPointPartition'
+
+
+def partition_name(date_time, mode):
+    if mode == 'yearly':
+        return f'TrackPoint_{date_time.year}'
+    if mode == 'monthly':
+        return f'TrackPoint_{date_time.year}_{date_time.month:02d}'
+    raise ValueError(f'Unknown partition mode: {mode}')
+
+
+class TrackPointPartitions:
+    """
+    Stores trackpoints in one collection per year or per month instead of the single TrackPoint collection.
+    Pass insert() as trackpoint_sink to walk().
+
+    Every partition is registered in the TrackPointPartition catalog, which trackpoint_collections() uses
+    to find the partitions that overlap a time range. Old partitions can be archived with Snapshot.py.
+    """
+
+    def __init__(self, db, mode='monthly'):
+        self.db = db
+        self.mode = mode
+
+    def insert(self, trackpoints):
+        partitions = {}
+        for tp in trackpoints:
+            partitions.setdefault(partition_name(tp['date_time'], self.mode), []).append(tp)
+
+        catalog_updates = []
+        for name, documents in partitions.items():
+            self.db[name].insert_many(documents)
+            date_times = [tp['date_time'] for tp in documents]
+            catalog_updates.append(UpdateOne(
+                {'_id': name},
+                {'$min': {'start': min(date_times)}, '$max': {'end': max(date_times)}, '$inc': {'count': len(documents)}},
+                upsert=True
+            ))
+
+        if catalog_updates:
+            self.db[CATALOG].bulk_write(catalog_updates, ordered=False)
+
+
+def trackpoint_collections(db, start=None, end=None, include_archived=True):
+    """
+    Returns the names of the collections that can hold trackpoints recorded from start (inclusive) to end (exclusive),
+    in chronological order. Without partitions this is always the TrackPoint collection.
+
+    Archived partitions are no longer in the database, so queries over them would give partial answers.
+    A RuntimeError naming them is raised, unless include_archived is False, in which case they are left out.
+    """
+    catalog = db[CATALOG]
+    if catalog.count_documents({}, limit=1) == 0:
+        return ['TrackPoint']
+
+    overlaps = {}
+    if start is not None:
+        overlaps['end'] = {'$gte': start}
+    if end is not None:
+        overlaps['start'] = {'$lt': end}
+
+    names, archived = [], []
+    for partition in catalog.find(overlaps, sort=[('start', 1)]):
+        if partition.get('archived'):
+            archived.append(f"{partition['_id']} (archived to {partition['archived']})")
+        else:
+            names.append(partition['_id'])
+
+    if archived and include_archived:
+        raise RuntimeError(f"Archived partitions are needed: {', '.join(archived)}. Import them with Snapshot.py, or pass include_archived=False to leave them out")
+    return names
@@ -0,0 +1,241 @@
+import numpy as np
+import pandas as pd
+from haversine import haversine_vector, Unit
+
+
+# Configuration of the optional simplification stage in walk(). Pass this (or a modified copy) to walk() to enable it.
+DEFAULT_SIMPLIFICATION = {
+    'algorithm': 'time_aware',      # 'douglas_peucker' (perpendicular distance) or 'time_aware' (synchronized euclidean distance)
+    'tolerance_m': 10,              # Maximum allowed deviation in meters of a removed point
+    'max_time_gap_seconds': 300,    # Never create new gaps this long between stored points, so query 9 in Part2 gives the same answer
+}
+
+# Same area as query 10 in Part2
+FORBIDDEN_CITY = (39.916 - 0.0005, 116.397 - 0.0005, 39.916 + 0.0005, 116.397 + 0.0005)
+
+
+def _to_meters(lat, lon):
+    # Local equirectangular projection. Accurate enough at the scale of a single trajectory
+    earth_radius = 6371008.8
+    x = np.radians(lon) * earth_radius * np.cos(np.radians(lat.mean()))
+    y = np.radians(lat) * earth_radius
+    return x, y
+
+
+def _perpendicular_deviation(x, y):
+    # Distance from the points between first and last to the line segment first-last
+    def deviation(first, last):
+        px, py = x[first+1:last], y[first+1:last]
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        seg_len2 = dx*dx + dy*dy
+        if seg_len2 == 0:
+            return np.hypot(px - x[first], py - y[first])
+        u = np.clip(((px - x[first])*dx + (py - y[first])*dy) / seg_len2, 0, 1)
+        return np.hypot(px - (x[first] + u*dx), py - (y[first] + u*dy))
+    return deviation
+
+
+def _synchronized_deviation(x, y, t):
+    # Distance from the points between first and last to where they would be when moving at constant speed from first to last
+    def deviation(first, last):
+        ratio = (t[first+1:last] - t[first]) / (t[last] - t[first])
+        expected_x = x[first] + ratio * (x[last] - x[first])
+        expected_y = y[first] + ratio * (y[last] - y[first])
+        return np.hypot(x[first+1:last] - expected_x, y[first+1:last] - expected_y)
+    return deviation
+
+
+def _douglas_peucker(deviation, keep, tolerance):
+    # Splits the ranges between consecutive points that are already kept until no removed point deviates more than tolerance
+    indices = np.flatnonzero(keep)
+    stack = list(zip(indices[:-1], indices[1:]))
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        d = deviation(first, last)
+        i = int(np.argmax(d))
+        if d[i] > tolerance:
+            mid = first + 1 + i
+            keep[mid] = True
+            stack.append((first, mid))
+            stack.append((mid, last))
+    return keep
+
+
+def _keep_time_gaps(keep, t, max_gap):
+    # Keep a removed point if skipping it would make the gap from the last stored point at least max_gap long.
+    # Gaps that already exist in the raw data are left as they are
+    last_kept = 0
+    for i in range(1, len(t)):
+        if keep[i]:
+            last_kept = i
+        elif t[i+1] - t[last_kept] >= max_gap:
+            keep[i] = True
+            last_kept = i
+    return keep
+
+
+def _max_error(deviation, keep):
+    indices = np.flatnonzero(keep)
+    error = 0.0
+    for first, last in zip(indices[:-1], indices[1:]):
+        if last - first >= 2:
+            error = max(error, float(deviation(first, last).max()))
+    return error
+
+
+def _altitude_error(altitude, t, keep):
+    # Largest difference in meters between the altitude of a removed point and the altitude interpolated in time between the kept points
+    valid = ~np.isnan(altitude)
+    removed, kept = valid & ~keep, valid & keep
+    if not removed.any() or not kept.any():
+        return 0.0
+    interpolated = np.interp(t[removed], t[kept], altitude[kept])
+    return float(np.abs(altitude[removed] - interpolated).max()) / 3.281
+
+
+def simplify_trackpoints(df, config=DEFAULT_SIMPLIFICATION):
+    """
+    Simplifies (a segment of) the trajectory of a single activity with Douglas-Peucker, bounded by config['tolerance_m'] meters.
+    Expects a DataFrame with the columns lat, lon and date_time, sorted by date_time, and optionally altitude (feet).
+    The points with the highest and lowest altitude are always kept, so the altitude gain of query 8 in Part2 does not change.
+
+    Returns the simplified DataFrame and a dict with the original point count, the simplification error,
+    i.e. the largest deviation in meters of a removed point, and the altitude error, i.e. the largest difference in meters
+    between the altitude of a removed point and the altitude interpolated between the stored points.
+    """
+    n = len(df)
+    if n < 3:
+        return df, {'original_point_count': n, 'simplification_error': 0.0, 'altitude_error': 0.0}
+
+    x, y = _to_meters(df['lat'].to_numpy(), df['lon'].to_numpy())
+    t = df['date_time'].to_numpy().astype('int64') / 1e9
+
+    if config['algorithm'] == 'douglas_peucker':
+        deviation = _perpendicular_deviation(x, y)
+    elif config['algorithm'] == 'time_aware':
+        deviation = _synchronized_deviation(x, y, t)
+    else:
+        raise ValueError(f"Unknown simplification algorithm: {config['algorithm']}")
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    altitude = df['altitude'].to_numpy(dtype=float) if 'altitude' in df else np.full(n, np.nan)
+    if not np.isnan(altitude).all():
+        keep[np.nanargmax(altitude)] = keep[np.nanargmin(altitude)] = True
+    keep = _douglas_peucker(deviation, keep, config['tolerance_m'])
+    if config['max_time_gap_seconds'] is not None:
+        # The points kept for the time gaps split the ranges Douglas-Peucker checked, so the new ranges are checked again
+        keep = _keep_time_gaps(keep, t, config['max_time_gap_seconds'])
+        keep = _douglas_peucker(deviation, keep, config['tolerance_m'])
+
+    error = _max_error(deviation, keep)
+    assert error <= config['tolerance_m'], f'Simplification error {error:.2f} m exceeds the tolerance'
+    return df[keep], {'original_point_count': n, 'simplification_error': error, 'altitude_error': _altitude_error(altitude, t, keep)}
+
+
+def distance_km(df):
+    if len(df) < 2:
+        return 0.0
+    coords = df[['lat', 'lon']].to_numpy()
+    return float(haversine_vector(coords[:-1], coords[1:], Unit.KILOMETERS).sum())
+
+
+def visits_area(df, area=FORBIDDEN_CITY):
+    min_lat, min_lon, max_lat, max_lon = area
+    lat, lon = df['lat'].to_numpy(), df['lon'].to_numpy()
+    return bool(((lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)).any())
+
+
+class _TrajectorySummary:
+    # Running query answers for one activity, which walk() may read in several chunks
+
+    def __init__(self):
+        self.last = None
+        self.distance = 0.0
+        self.first_altitude = None
+        self.max_altitude = None
+        self.visited = False
+
+    def add(self, df):
+        if df.empty:
+            return
+        # Include the edge from the last point of the previous chunk
+        self.distance += distance_km(df if self.last is None else pd.concat([self.last, df]))
+        self.last = df.iloc[-1:]
+
+        altitude = df['altitude'].dropna().to_numpy(dtype=float)
+        if len(altitude) > 0:
+            if self.first_altitude is None:
+                self.first_altitude = altitude[0]
+                self.max_altitude = altitude.max()
+            self.max_altitude = max(self.max_altitude, altitude.max())
+
+        self.visited = self.visited or visits_area(df)
+
+    def altitude_gain_m(self):
+        # Same definition as Top20AltitudeGainers in Part2: the altitude only counts as gained when it rises above the highest altitude seen so far
+        if self.first_altitude is None:
+            return 0.0
+        return float(self.max_altitude - self.first_altitude) / 3.281
+
+
+class SimplificationReport:
+    """
+    Collects query answers on the raw and the simplified trajectories during walk(), so the effect of the tolerance can be judged.
+    walk() calls start_activity() for every activity, and add() for every chunk of it.
+    """
+
+    def __init__(self):
+        self.raw_points = 0
+        self.simplified_points = 0
+        self.max_error = 0.0
+        self.max_altitude_error = 0.0
+        self.raw_distance = 0.0
+        self.simplified_distance = 0.0
+        self.raw_altitude_gain = 0.0
+        self.simplified_altitude_gain = 0.0
+        self.raw_visits = 0
+        self.simplified_visits = 0
+        self._raw = None
+        self._simplified = None
+
+    def start_activity(self):
+        self._finish_activity()
+        self._raw, self._simplified = _TrajectorySummary(), _TrajectorySummary()
+
+    def _finish_activity(self):
+        if self._raw is None:
+            return
+        self.raw_distance += self._raw.distance
+        self.simplified_distance += self._simplified.distance
+        self.raw_altitude_gain += self._raw.altitude_gain_m()
+        self.simplified_altitude_gain += self._simplified.altitude_gain_m()
+        self.raw_visits += self._raw.visited
+        self.simplified_visits += self._simplified.visited
+        self._raw, self._simplified = None, None
+
+    def add(self, raw_df, simplified_df, stats):
+        self.raw_points += len(raw_df)
+        self.simplified_points += len(simplified_df)
+        self.max_error = max(self.max_error, stats['simplification_error'])
+        self.max_altitude_error = max(self.max_altitude_error, stats['altitude_error'])
+        self._raw.add(raw_df)
+        self._simplified.add(simplified_df)
+
+    def rows(self):
+        self._finish_activity()
+
+        def relative(raw, simplified):
+            return (simplified - raw) / raw * 100 if raw else 0.0
+
+        rows = [
+            ('trackpoints', self.raw_points, self.simplified_points, relative(self.raw_points, self.simplified_points)),
+            ('distance (km)', self.raw_distance, self.simplified_distance, relative(self.raw_distance, self.simplified_distance)),
+            ('altitude gain (m)', self.raw_altitude_gain, self.simplified_altitude_gain, relative(self.raw_altitude_gain, self.simplified_altitude_gain)),
+            ('activities visiting Forbidden City', self.raw_visits, self.simplified_visits, relative(self.raw_visits, self.simplified_visits)),
+            ('max simplification error (m)', 0.0, self.max_error, None),
+            ('max altitude error (m)', 0.0, self.max_altitude_error, None),
+        ]
+        return rows, ("measure", "raw", "simplified", "difference (%)")
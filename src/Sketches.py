@@ -0,0 +1,238 @@
+import math
+
+import numpy as np
+from bson.binary import Binary
+from pymongo import ASCENDING
+
+
+def hash64(values, seed=0):
+    # splitmix64 finalizer, vectorized over an array of integers. Different seeds give independent hash functions
+    with np.errstate(over='ignore'):
+        z = np.asarray(values, dtype=np.int64).astype(np.uint64) + np.uint64((0x9E3779B97F4A7C15 * (seed + 1)) & 0xFFFFFFFFFFFFFFFF)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+class HyperLogLog:
+    """
+    Estimates the number of distinct integers added to it, using 2^p one-byte registers.
+    The relative standard error of the estimate is 1.04 / sqrt(2^p).
+    """
+
+    def __init__(self, p=8, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = np.zeros(self.m, dtype=np.uint8) if registers is None else registers
+
+    def add(self, values):
+        h = hash64(values)
+        index = (h >> np.uint64(64 - self.p)).astype(np.int64)
+        rest = h & np.uint64((1 << (64 - self.p)) - 1)
+
+        # Rank is the position of the leftmost 1-bit in the remaining 64 - p bits
+        bit_length = np.zeros(len(rest), dtype=np.int64)
+        nonzero = rest > 0
+        bit_length[nonzero] = np.frexp(rest[nonzero].astype(np.float64))[1]
+        rank = (64 - self.p) - bit_length + 1
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        m = self.m
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        raw = alpha * m * m / np.sum(2.0 ** -self.registers.astype(np.float64))
+
+        # Small range correction (linear counting)
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros > 0:
+            return m * math.log(m / zeros)
+        return float(raw)
+
+    def relative_error(self):
+        return 1.04 / math.sqrt(self.m)
+
+    def to_binary(self):
+        return Binary(self.registers.tobytes())
+
+    @staticmethod
+    def from_binary(data, p=None):
+        # The number of registers is 2^p, so p can be found from the length of the data
+        p = p or len(data).bit_length() - 1
+        return HyperLogLog(p, np.frombuffer(data, dtype=np.uint8).copy())
+
+
+class CountMinSketch:
+    """
+    Estimates the total weight added for every key with a depth x width table of counters.
+    Estimates never undercount, and overcount by at most e / width * total weight with probability 1 - e^-depth.
+    """
+
+    def __init__(self, width=2048, depth=5, table=None, total=0.0):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.float64) if table is None else table
+        self.total = total
+
+    def _columns(self, keys, row):
+        return (hash64(keys, seed=row) % np.uint64(self.width)).astype(np.int64)
+
+    def add(self, keys, weights):
+        keys = np.asarray(keys, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float64)
+        for row in range(self.depth):
+            np.add.at(self.table[row], self._columns(keys, row), weights)
+        self.total += float(weights.sum())
+
+    def estimate(self, keys):
+        keys = np.asarray(keys, dtype=np.int64)
+        return np.min([self.table[row][self._columns(keys, row)] for row in range(self.depth)], axis=0)
+
+    def error(self):
+        return math.e / self.width * self.total
+
+    def to_document(self):
+        return {'width': self.width, 'depth': self.depth, 'total': self.total, 'table': Binary(self.table.tobytes())}
+
+    @staticmethod
+    def from_document(document):
+        table = np.frombuffer(document['table'], dtype=np.float64).reshape(document['depth'], document['width']).copy()
+        return CountMinSketch(document['width'], document['depth'], table, document['total'])
+
+
+class HeavyHitters:
+    """
+    Count-Min sketch that also keeps the k keys with the highest estimated weight (top-k).
+    """
+
+    def __init__(self, k=20, width=2048, depth=5):
+        self.k = k
+        self.sketch = CountMinSketch(width, depth)
+        self.top = {}
+
+    def add(self, keys, weights):
+        self.sketch.add(keys, weights)
+        keys = np.unique(np.asarray(keys, dtype=np.int64))
+        for key, estimate in zip(keys.tolist(), self.sketch.estimate(keys).tolist()):
+            self.top[key] = estimate
+        while len(self.top) > self.k:
+            del self.top[min(self.top, key=self.top.get)]
+
+    def to_document(self):
+        document = self.sketch.to_document()
+        document['top'] = sorted(self.top.items(), key=lambda item: item[1], reverse=True)
+        return document
+
+
+class ReservoirSample:
+    """
+    Uniform sample of at most k rows of a stream of DataFrames (algorithm R, vectorized per DataFrame).
+    """
+
+    def __init__(self, k, columns, rng):
+        self.k = k
+        self.seen = 0
+        self.rng = rng
+        self.columns = {column: np.empty(k, dtype=np.float64) for column in columns}
+
+    def add(self, df):
+        positions = self.seen + np.arange(len(df))
+        self.seen += len(df)
+
+        # Fill the reservoir first, then replace a random slot with probability k / (position + 1)
+        fill = positions < self.k
+        slots = np.where(fill, positions, self.rng.integers(0, positions + 1))
+        keep = slots < self.k
+        for column, sample in self.columns.items():
+            sample[slots[keep]] = df[column].to_numpy(dtype=np.float64)[keep]
+
+    def values(self, column):
+        return self.columns[column][:min(self.seen, self.k)].tolist()
+
+
+class GeolifeSketches:
+    """
+    Sketches that walk() builds during ingestion, used by the approximate queries in Part2:
+    - a HyperLogLog of distinct users for every grid cell of cell_size degrees (SketchCell collection)
+    - top-k altitude gainers and recorded seconds per year, in Count-Min sketches (Sketch collection)
+    - a reservoir sample of the trackpoints of every activity (ActivitySample collection)
+    """
+
+    def __init__(self, cell_size=0.01, p=8, sample_size=50, top_k=20, width=2048, depth=5, seed=None):
+        self.cell_size = cell_size
+        self.p = p
+        self.sample_size = sample_size
+        self.cells = {}
+        self.altitude_gainers = HeavyHitters(top_k, width, depth)
+        self.year_seconds = HeavyHitters(top_k, width, depth)
+        self.samples = []
+        self.rng = np.random.default_rng(seed)
+
+    def start_activity(self, user_id):
+        self.user_id = user_id
+        self.first_altitude = None
+        self.max_altitude = None
+        self.point_count = 0
+        self.bbox = None
+        self.sample = ReservoirSample(self.sample_size, ['lat', 'lon'], self.rng)
+
+    def add(self, df):
+        lat, lon = df['lat'].to_numpy(), df['lon'].to_numpy()
+
+        # Add the user to every grid cell the segment passes through
+        cells = np.unique(np.stack([np.floor(lat / self.cell_size), np.floor(lon / self.cell_size)], axis=1).astype(np.int64), axis=0)
+        user = np.array([int(self.user_id)])
+        for lat_index, lon_index in cells.tolist():
+            cell = self.cells.get((lat_index, lon_index))
+            if cell is None:
+                cell = self.cells[(lat_index, lon_index)] = HyperLogLog(self.p)
+            cell.add(user)
+
+        # Same definition of altitude gain as Top20AltitudeGainers in Part2
+        altitude = df['altitude'].dropna().to_numpy(dtype=float)
+        if len(altitude) > 0:
+            if self.first_altitude is None:
+                self.first_altitude = self.max_altitude = altitude[0]
+            self.max_altitude = max(self.max_altitude, altitude.max())
+
+        bbox = (lat.min(), lon.min(), lat.max(), lon.max())
+        self.bbox = bbox if self.bbox is None else (min(self.bbox[0], bbox[0]), min(self.bbox[1], bbox[1]), max(self.bbox[2], bbox[2]), max(self.bbox[3], bbox[3]))
+        self.point_count += len(df)
+        self.sample.add(df)
+
+    def finish_activity(self, activity_dict):
+        user = [int(self.user_id)]
+        if self.first_altitude is not None:
+            self.altitude_gainers.add(user, [(self.max_altitude - self.first_altitude) / 3.281])
+
+        # Same definition of recorded time as yearWithMostRecordedHours in Part2
+        seconds = (activity_dict['end_date_time'] - activity_dict['start_date_time']).total_seconds()
+        self.year_seconds.add([activity_dict['start_date_time'].year], [seconds])
+
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        self.samples.append({'_id': activity_dict['_id'], 'user_id': self.user_id, 'point_count': self.point_count,
+                             'min_lat': min_lat, 'min_lon': min_lon, 'max_lat': max_lat, 'max_lon': max_lon,
+                             'lat': self.sample.values('lat'), 'lon': self.sample.values('lon')})
+
+    def save(self, db):
+        # The sketches of this ingestion replace any previously saved sketches
+        for collection_name in ('Sketch', 'SketchCell', 'ActivitySample'):
+            db[collection_name].drop()
+
+        db['Sketch'].insert_many([
+            {'_id': 'config', 'cell_size': self.cell_size, 'p': self.p, 'sample_size': self.sample_size},
+            dict(self.altitude_gainers.to_document(), _id='altitude_gain'),
+            dict(self.year_seconds.to_document(), _id='year_seconds'),
+        ])
+
+        cells = [{'_id': f'{lat_index}:{lon_index}', 'lat_index': lat_index, 'lon_index': lon_index, 'users': hll.to_binary()}
+                 for (lat_index, lon_index), hll in self.cells.items()]
+        if cells:
+            db['SketchCell'].insert_many(cells)
+        db['SketchCell'].create_index([('lat_index', ASCENDING), ('lon_index', ASCENDING)])
+
+        if self.samples:
+            db['ActivitySample'].insert_many(self.samples)
+        print(f'Saved sketches: {len(cells)} grid cells, {len(self.samples)} activity samples')
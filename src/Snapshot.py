@@ -0,0 +1,191 @@
+import argparse
+import gzip
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import bson
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import IndexModel
+from Part1 import Part1
+from Partitions import CATALOG, trackpoint_collections
+
+
+COLLECTIONS = ['User', 'Activity', 'TrackPoint']
+
+# Collections that walk() builds next to the data, which can only be rebuilt by ingesting the dataset again
+DERIVED_COLLECTIONS = ['Sketch', 'SketchCell', 'ActivitySample', 'TrackPointTile']
+
+# Documents are kept as raw BSON on import, so they are never decoded to dicts and encoded again
+RAW = CodecOptions(document_class=RawBSONDocument)
+
+
+class Snapshot:
+    """
+    Exports the geolife collections to a directory of compressed chunk files, and imports them again.
+    Every chunk is a gzipped sequence of BSON documents that can be read independently of the others,
+    and manifest.json holds the document counts, collection options and index definitions.
+
+    Usage:
+    python Snapshot.py export ../snapshot
+    python Snapshot.py import ../snapshot --drop
+    python Snapshot.py archive ../archive/2007 --collections TrackPoint_2007_04 TrackPoint_2007_05
+    """
+
+    def __init__(self, workers=4):
+        self.program = Part1()
+        self.db = self.program.db
+        self.workers = workers
+
+    # User, Activity and the trackpoints, including the time partitions that are not archived and their catalog if trackpoints are partitioned,
+    # and the sketches and density tiles for the approximate queries and hotspots in Part2
+    def default_collections(self):
+        existing = self.db.list_collection_names()
+        names = COLLECTIONS + trackpoint_collections(self.db, include_archived=False) + [CATALOG] + DERIVED_COLLECTIONS
+        return [name for name in dict.fromkeys(names) if name in existing]
+
+    def export(self, directory, collection_names=None, chunk_size=100000, compresslevel=1):
+        collection_names = collection_names or self.default_collections()
+        os.makedirs(directory, exist_ok=True)
+        manifest = {'database': self.db.name, 'collections': {}}
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            for collection_name in collection_names:
+                collection = self.db[collection_name]
+                files, count, pending = [], 0, set()
+
+                # Read raw batches from the server while earlier chunks are compressed and written by the executor
+                for number, batch in enumerate(collection.find_raw_batches({}, batch_size=chunk_size)):
+                    file_name = f'{collection_name}-{number:05d}.bson.gz'
+                    files.append(file_name)
+                    count += len(bson.decode_all(batch, RAW))
+                    pending.add(executor.submit(self._write_chunk, os.path.join(directory, file_name), batch, compresslevel))
+
+                    # Bound the number of batches waiting in memory
+                    if len(pending) >= 2 * self.workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+
+                for future in pending:
+                    future.result()
+
+                manifest['collections'][collection_name] = {
+                    'count': count,
+                    'files': files,
+                    'options': collection.options(),
+                    'indexes': [index for index in collection.list_indexes() if index['name'] != '_id_'],
+                }
+                print(f'Exported {count} documents from {collection_name} in {len(files)} chunks')
+
+        with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+            f.write(json_util.dumps(manifest, indent=2))
+
+    def restore(self, directory, drop=False):
+        with open(os.path.join(directory, 'manifest.json'), 'r') as f:
+            manifest = json_util.loads(f.read())
+
+        start = time.time()
+        existing = self.db.list_collection_names()
+        for collection_name, info in manifest['collections'].items():
+            if collection_name in existing:
+                if not drop:
+                    raise RuntimeError(f'Collection {collection_name} already exists, use --drop to replace it')
+                self.program.drop_coll(collection_name)
+            self.program.create_coll(collection_name, **info['options'])
+
+        # Insert all chunks in parallel. Indexes other than _id are built last, so inserts do not have to maintain them
+        with ThreadPoolExecutor(self.workers) as executor:
+            futures = [executor.submit(self._insert_chunk, collection_name, os.path.join(directory, file_name))
+                       for collection_name, info in manifest['collections'].items() for file_name in info['files']]
+            count = sum(future.result() for future in futures)
+        inserted = time.time()
+        print(f'Inserted {count} documents in {inserted - start:.1f} s')
+
+        for collection_name, info in manifest['collections'].items():
+            indexes = [self._index_model(index) for index in info['indexes']]
+            if indexes:
+                self.db[collection_name].create_indexes(indexes)
+                print(f'Built {len(indexes)} indexes on {collection_name}')
+        print(f'Built indexes in {time.time() - inserted:.1f} s')
+        print(f'Restored snapshot in {time.time() - start:.1f} s')
+
+        # Restored time partitions are no longer archived
+        self.db[CATALOG].update_many({'_id': {'$in': list(manifest['collections'])}, 'archived': {'$exists': True}}, {'$unset': {'archived': ''}})
+
+    # Exports time partitions and drops them from the database. They stay in the catalog, marked as archived,
+    # so queries that need them raise an error instead of giving partial answers until they are imported again
+    def archive(self, directory, collection_names, chunk_size=100000):
+        # Only time partitions that are still in the database can be archived. Nothing is exported or dropped otherwise
+        partitions = {partition['_id']: partition for partition in self.db[CATALOG].find({'_id': {'$in': list(collection_names)}})}
+        unknown = [name for name in collection_names if name not in partitions]
+        if unknown:
+            raise ValueError(f"Only time partitions in the {CATALOG} catalog can be archived, not: {', '.join(unknown)}")
+        archived = [name for name in collection_names if partitions[name].get('archived')]
+        if archived:
+            raise ValueError(f"Partitions are already archived: {', '.join(archived)}")
+
+        self.export(directory, collection_names=collection_names, chunk_size=chunk_size)
+        for collection_name in collection_names:
+            self.program.drop_coll(collection_name)
+            self.db[CATALOG].update_one({'_id': collection_name}, {'$set': {'archived': directory}})
+
+    def _write_chunk(self, path, batch, compresslevel):
+        with gzip.open(path, 'wb', compresslevel=compresslevel) as f:
+            f.write(batch)
+
+    def _insert_chunk(self, collection_name, path):
+        with gzip.open(path, 'rb') as f:
+            documents = bson.decode_all(f.read(), RAW)
+        if documents:
+            self.db[collection_name].insert_many(documents, ordered=False, bypass_document_validation=True)
+        return len(documents)
+
+    def _index_model(self, index):
+        options = {key: value for key, value in index.items() if key not in ('key', 'v', 'ns')}
+        return IndexModel(list(index['key'].items()), **options)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export or import a snapshot of the geolife collections')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help='Export collections to compressed chunk files')
+    export_parser.add_argument('directory')
+    export_parser.add_argument('--collections', nargs='+', help='Defaults to User, Activity, all trackpoint collections, the sketches and the density tiles')
+    export_parser.add_argument('--chunk-size', type=int, default=100000, help='Documents per chunk file')
+    export_parser.add_argument('--workers', type=int, default=4)
+
+    import_parser = commands.add_parser('import', help='Import a snapshot with parallel unordered bulk inserts')
+    import_parser.add_argument('directory')
+    import_parser.add_argument('--drop', action='store_true', help='Replace collections that already exist')
+    import_parser.add_argument('--workers', type=int, default=4)
+
+    archive_parser = commands.add_parser('archive', help='Export time partitions of TrackPoint and drop them from the database')
+    archive_parser.add_argument('directory')
+    archive_parser.add_argument('--collections', nargs='+', required=True)
+    archive_parser.add_argument('--chunk-size', type=int, default=100000, help='Documents per chunk file')
+    archive_parser.add_argument('--workers', type=int, default=4)
+
+    args = parser.parse_args()
+
+    snapshot = None
+    try:
+        snapshot = Snapshot(workers=args.workers)
+        if args.command == 'export':
+            snapshot.export(args.directory, collection_names=args.collections, chunk_size=args.chunk_size)
+        elif args.command == 'archive':
+            snapshot.archive(args.directory, args.collections, chunk_size=args.chunk_size)
+        else:
+            snapshot.restore(args.directory, drop=args.drop)
+    except Exception as e:
+        print("ERROR: Failed to use database:", e)
+    finally:
+        if snapshot:
+            snapshot.program.connection.close_connection()
+
+
+if __name__ == '__main__':
+    main()
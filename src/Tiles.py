@@ -0,0 +1,99 @@
+import math
+
+import numpy as np
+from pymongo import ASCENDING, DESCENDING, ReplaceOne
+from Sketches import HyperLogLog
+
+
+def tile_index(lat, lon, zoom):
+    """
+    Web Mercator (slippy map) tile x and y of every lat/lon at the given zoom level. Works on numbers and numpy arrays.
+    """
+    n = 2 ** zoom
+    lat_rad = np.radians(np.clip(lat, -85.0511, 85.0511))
+    x = np.floor((np.asarray(lon) + 180) / 360 * n)
+    y = np.floor((1 - np.log(np.tan(lat_rad) + 1 / np.cos(lat_rad)) / np.pi) / 2 * n)
+    return np.clip(x, 0, n - 1).astype(np.int64), np.clip(y, 0, n - 1).astype(np.int64)
+
+
+def tile_bounds(zoom, x, y):
+    """
+    Returns (min_lat, min_lon, max_lat, max_lon) of a tile.
+    """
+    n = 2 ** zoom
+
+    def lat(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return lat(y + 1), x / n * 360 - 180, lat(y), (x + 1) / n * 360 - 180
+
+
+class TilePyramid:
+    """
+    Bins trackpoints into tiles for every zoom level from min_zoom to max_zoom while walk() reads them.
+    Every tile document in the collection holds the number of trackpoints, the distinct users, and a HyperLogLog of the activities in the tile.
+
+    Tiles are merged into the documents that are already stored when flushed, so the pyramid can be updated incrementally
+    with new trackpoints. The pyramid does not know which trackpoints it already holds, so only add trackpoints that were not added before,
+    or drop the collection first when the whole dataset is read again. The tiles are flushed automatically when more than max_tiles are kept in memory.
+    """
+
+    def __init__(self, db, collection_name='TrackPointTile', min_zoom=2, max_zoom=16, p=8, max_tiles=100000):
+        self.collection = db[collection_name]
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.p = p
+        self.max_tiles = max_tiles
+        self.tiles = {}
+
+    def add(self, df, user_id, activity_id):
+        # Tiles are nested, so the tiles of lower zoom levels are found by shifting the tiles at max_zoom
+        x, y = tile_index(df['lat'].to_numpy(), df['lon'].to_numpy(), self.max_zoom)
+        activity = np.array([activity_id])
+
+        for zoom in range(self.min_zoom, self.max_zoom + 1):
+            shift = self.max_zoom - zoom
+            tiles, counts = np.unique(np.stack([x >> shift, y >> shift], axis=1), axis=0, return_counts=True)
+
+            for (tile_x, tile_y), count in zip(tiles.tolist(), counts.tolist()):
+                tile = self.tiles.get((zoom, tile_x, tile_y))
+                if tile is None:
+                    tile = self.tiles[(zoom, tile_x, tile_y)] = {'count': 0, 'users': set(), 'activities': HyperLogLog(self.p)}
+                tile['count'] += count
+                tile['users'].add(user_id)
+                tile['activities'].add(activity)
+
+        if len(self.tiles) > self.max_tiles:
+            self.flush()
+
+    def flush(self):
+        if not self.tiles:
+            return
+
+        # Fetch the stored version of the tiles to merge with
+        ids = [f'{zoom}/{x}/{y}' for zoom, x, y in self.tiles]
+        existing = {}
+        for start in range(0, len(ids), 10000):
+            for document in self.collection.find({'_id': {'$in': ids[start:start + 10000]}}):
+                existing[document['_id']] = document
+
+        operations = []
+        for tile_id, ((zoom, x, y), tile) in zip(ids, self.tiles.items()):
+            document = existing.get(tile_id)
+            if document is not None:
+                tile['count'] += document['count']
+                tile['users'].update(document['users'])
+                tile['activities'].merge(HyperLogLog.from_binary(document['activities']))
+
+            operations.append(ReplaceOne({'_id': tile_id}, {
+                'z': zoom, 'x': x, 'y': y,
+                'count': tile['count'],
+                'users': sorted(tile['users']),
+                'activities': tile['activities'].to_binary(),
+            }, upsert=True))
+
+        self.collection.bulk_write(operations, ordered=False)
+        self.collection.create_index([('z', ASCENDING), ('x', ASCENDING), ('y', ASCENDING)])
+        self.collection.create_index([('z', ASCENDING), ('count', DESCENDING)])
+        print(f'Flushed {len(operations)} tiles')
+        self.tiles = {}